@@ -2,21 +2,25 @@ import logging
 import os
 import re
 import sys
+import tempfile
 import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from difflib import ndiff
-from hashlib import md5
+from difflib import SequenceMatcher
+from email.utils import parsedate_to_datetime
+from hashlib import blake2b
+from io import BytesIO
 from typing import Optional
 
-import feedparser
 import humanize
 import requests
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
-from bs4 import BeautifulSoup
 from peewee import SqliteDatabase, Model, TextField, IntegerField
 from requests import RequestException
 from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 from urllib3.util import Retry
 
 BOT_TOKEN = os.environ['BOT_TOKEN']
@@ -26,19 +30,37 @@ TELEGRAM_LOGS_CHANNEL = -1001626800013
 
 DATABASE_PATH = os.environ.get('DATABASE_PATH', 'ildolomiti.db')
 
+ARTICLE_TAG_REGEX = re.compile(r'https://www\.ildolomiti\.it/([a-z-]+)/')
+TELEGRAM_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s - %(message)s',
                     datefmt='%Y-%m-%dT%H:%M:%S%z', stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
 logger.info('Database path: ' + DATABASE_PATH)
 
-db = SqliteDatabase(DATABASE_PATH)
+session = requests.Session()
+session.headers['User-Agent'] = 'Il Dolomiti Telegram (+https://github.com/matteocontrini/ildolomiti-telegram)'
+session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    # POST requests are not retried, so messages are never sent twice
+    max_retries=Retry(total=2, status_forcelist=[502, 503, 504], backoff_factor=0.3, raise_on_status=False)
+))
+
+db = SqliteDatabase(DATABASE_PATH, pragmas={
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -8000,  # 8 MB
+    'temp_store': 'memory',
+    'mmap_size': 268435456,  # 256 MB
+})
 
 
 class Article(Model):
-    post_id = IntegerField(null=True)
+    post_id = IntegerField(null=True, index=True)
     title = TextField()
-    link = TextField()
+    link = TextField(index=True)
     published = IntegerField()
     telegram_message_id = IntegerField(null=True)
 
@@ -46,6 +68,19 @@ class Article(Model):
         database = db
 
 
+# Validators of the last feed that was fully processed, used for conditional requests
+feed_etag: Optional[str] = None
+feed_last_modified: Optional[str] = None
+
+
+@dataclass
+class FeedEntry:
+    title: str
+    link: str
+    description: str
+    published_parsed: time.struct_time
+
+
 @dataclass
 class TelegramMessage:
     title: str
@@ -56,56 +91,112 @@ class TelegramMessage:
 
 
 def check():
+    global feed_etag, feed_last_modified
+
     logger.info('Checking...')
 
     url = 'https://www.ildolomiti.it/rss.xml?_=' + str(int(time.time()))
     logger.info(f'Fetching {url}')
 
-    resp = requests.get(url, headers={
-        'User-Agent': 'Il Dolomiti Telegram (+https://github.com/matteocontrini/ildolomiti-telegram)'
-    })
+    headers = {}
+    if feed_etag:
+        headers['If-None-Match'] = feed_etag
+    if feed_last_modified:
+        headers['If-Modified-Since'] = feed_last_modified
+
+    resp = session.get(url, headers=headers)
+
+    if resp.status_code == 304:
+        logger.info('Feed not modified')
+        return
 
     if resp.status_code != 200:
         logger.error(f'Error fetching feed ({resp.status_code}): {resp.text}')
         return
 
-    feed = feedparser.parse(resp.text)
-
-    if feed.bozo:
-        logger.error(f'Error parsing feed: {feed.bozo_exception}')
+    try:
+        entries = parse_feed(resp.content)
+    except (ElementTree.ParseError, ValueError, TypeError) as e:
+        logger.error(f'Error parsing feed: {e}')
         return
 
-    if Article.select().count() == 0:
-        first_run(feed)
+    if not Article.select().exists():
+        first_run(entries)
+        feed_etag = resp.headers.get('ETag')
+        feed_last_modified = resp.headers.get('Last-Modified')
         return
 
-    for entry in reversed(feed.entries):
-        article = Article.get_or_none(link=entry.link)
-        if not article:
-            process_new_article(entry)
+    # Skip blog/necrologi/video before even looking them up
+    candidates = []
+    for entry in reversed(entries):
+        tags = get_tags(entry.link)
+        if tags is not None:
+            candidates.append((entry, tags))
+
+    links = [entry.link for entry, _ in candidates]
+    known_links = {link for link, in Article.select(Article.link).where(Article.link.in_(links)).tuples()}
+
+    new_entries = []
+    for entry, tags in candidates:
+        if entry.link not in known_links:
+            new_entries.append((entry, tags))
+            known_links.add(entry.link)  # in case the feed lists it twice
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        # Article pages are fetched concurrently, but messages are still sent in feed order
+        all_details = pool.map(lambda e: fetch_article_details(e[0].link), new_entries)
+        completed = True
+        for (entry, tags), details in zip(new_entries, all_details):
+            if not process_new_article(entry, tags, details):
+                completed = False
+
+    # Otherwise the feed must be fetched again to retry the failed articles
+    if completed:
+        feed_etag = resp.headers.get('ETag')
+        feed_last_modified = resp.headers.get('Last-Modified')
 
     logger.info('Done!')
 
 
-def first_run(feed):
+def parse_feed(content: bytes) -> list[FeedEntry]:
+    entries = []
+    for _, item in ElementTree.iterparse(BytesIO(content)):
+        if item.tag != 'item':
+            continue
+        entries.append(FeedEntry(
+            title=item.findtext('title', '').strip(),
+            link=item.findtext('link', '').strip(),
+            description=item.findtext('description', '').strip(),
+            # UTC, like feedparser's *_parsed fields
+            published_parsed=parsedate_to_datetime(item.findtext('pubDate')).utctimetuple(),
+        ))
+        item.clear()
+    return entries
+
+
+def first_run(entries: list[FeedEntry]):
     logger.info('First run, populating database...')
-    for entry in reversed(feed.entries):
-        article = Article(
-            post_id=None,
-            title=entry.title,
-            link=entry.link,
-            published=int(time.mktime(entry.published_parsed)),
-            telegram_message_id=None
-        )
-        article.save()
+    links = set()
+    with db.atomic():
+        for entry in reversed(entries):
+            if entry.link in links:  # in case the feed lists it twice
+                continue
+            links.add(entry.link)
+            Article.create(
+                post_id=None,
+                title=entry.title,
+                link=entry.link,
+                published=int(time.mktime(entry.published_parsed)),
+                telegram_message_id=None
+            )
     logger.info('Done!')
 
 
-def process_new_article(entry):
-    tag = re.match(r'https://www\.ildolomiti\.it/([a-z-]+)/', entry.link)
+def get_tags(link: str) -> Optional[list[str]]:
+    tag = ARTICLE_TAG_REGEX.match(link)
     tag = tag.group(1) if tag else None
-    if tag == 'blog' or tag == 'necrologi' or tag == 'video':
-        return
+    if not tag or tag == 'blog' or tag == 'necrologi' or tag == 'video':
+        return None
 
     # es. "ricerca-e-universita" -> #ricerca #universita
     if '-' in tag:
@@ -114,8 +205,10 @@ def process_new_article(entry):
     else:
         tags = [tag]
 
-    details = fetch_article_details(entry.link)
+    return tags
+
 
+def process_new_article(entry: FeedEntry, tags: list[str], details: dict) -> bool:
     message = TelegramMessage(
         title=entry.title.strip(),
         link=entry.link,
@@ -134,7 +227,7 @@ def process_new_article(entry):
             send_message(message, article.telegram_message_id)
         except RequestException:
             logger.exception('Error updating message')
-            return  # so that it's retried later
+            return False  # so that it's retried later
         send_log(article, entry)
         article.title = message.title
         article.link = message.link
@@ -146,7 +239,7 @@ def process_new_article(entry):
             message_id = send_message(message)
         except RequestException:
             logger.exception('Error sending message')
-            return  # so that it's retried later
+            return False  # so that it's retried later
         Article.create(
             post_id=details['post_id'],
             title=message.title,
@@ -155,42 +248,41 @@ def process_new_article(entry):
             telegram_message_id=message_id
         )
 
+    return True
+
 
 def fetch_article_details(link: str) -> dict:
-    resp = requests.get(
+    resp = session.get(
         link + '?_=' + str(int(time.time())),  # fix for 404 ending up in the dolomiti cache
-        headers={
-            'User-Agent': 'Il Dolomiti Telegram (+https://github.com/matteocontrini/ildolomiti-telegram)'
-        },
         timeout=10
     )
 
     resp.raise_for_status()
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
+    tree = LexborHTMLParser(resp.text)
 
     post_id = None
     description = None
     image = None
 
-    article = soup.select_one('article[id^="node-"]')
+    article = tree.css_first('article[id^="node-"]')
     if article:
-        post_id = article['id'].split('-')[1]
-        description = article.find('div', class_='artSub')
+        post_id = article.attributes['id'].split('-')[1]
+        description = article.css_first('div.artSub')
         if description:
-            description = description.text.strip()
+            description = description.text().strip()
         else:
             logger.error('Description not found')
-        image_url = soup.find('meta', property='og:image')
+        image_url = tree.css_first('meta[property="og:image"]')
         if image_url:
-            image_url = image_url['content']
+            image_url = image_url.attributes['content']
             image = download_image(image_url)
         else:
             logger.error('Image meta tag not found')
     else:
         logger.error('Article node not found')
 
-    tags = ['belluno'] if 'section="BELLUNO"' in resp.text else []
+    tags = ['belluno'] if b'section="BELLUNO"' in resp.content else []
 
     return {
         'post_id': post_id,
@@ -204,14 +296,20 @@ def download_image(image_url: str) -> Optional[str]:
     if not image_url:
         return None
     try:
-        session = requests.Session()
-        retries = Retry(total=2, status_forcelist=[502, 503, 504])
-        session.mount('https://', HTTPAdapter(max_retries=retries))
-        resp = session.get(image_url, timeout=10)
-        resp.raise_for_status()
-        filename = 'images/' + md5(image_url.encode('utf-8')).hexdigest()
-        with open(filename, 'wb') as f:
-            f.write(resp.content)
+        with session.get(image_url, timeout=10, stream=True) as resp:
+            resp.raise_for_status()
+            filename = 'images/' + blake2b(image_url.encode('utf-8'), digest_size=16).hexdigest()
+            # Articles sharing an image are downloaded concurrently, so never write
+            # to the final file directly: it could be getting uploaded already
+            with tempfile.NamedTemporaryFile('wb', dir='images', delete=False) as f:
+                try:
+                    for chunk in resp.iter_content(chunk_size=65536):
+                        f.write(chunk)
+                except (Exception,):
+                    f.close()
+                    os.remove(f.name)
+                    raise
+        os.replace(f.name, filename)
         return filename
     except (Exception,):
         logger.exception('Error downloading image')
@@ -219,18 +317,18 @@ def download_image(image_url: str) -> Optional[str]:
 
 
 def send_message(message: TelegramMessage, telegram_message_id=None) -> int:
-    msg = ''
+    parts = []
     if message.tags:
-        for tag in message.tags:
-            msg += f'#{tag} '
-        msg += '— '
+        parts.append(' '.join(f'#{tag}' for tag in message.tags) + ' — ')
 
-    msg += f'<strong>{telegram_escape(message.title)}</strong>'
+    parts.append(f'<strong>{telegram_escape(message.title)}</strong>')
 
     if message.description:
-        msg += f'\n\n<i>{telegram_escape(message.description)}</i>'
+        parts.append(f'\n\n<i>{telegram_escape(message.description)}</i>')
 
-    msg += f'\n\n📰 <a href="{message.link}">Leggi articolo</a>'
+    parts.append(f'\n\n📰 <a href="{message.link}">Leggi articolo</a>')
+
+    msg = ''.join(parts)
 
     if telegram_message_id:
         payload = {
@@ -239,18 +337,19 @@ def send_message(message: TelegramMessage, telegram_message_id=None) -> int:
             'caption': msg,
             'parse_mode': 'HTML',
         }
-        resp = requests.post(f'{TELEGRAM_API_URL}/editMessageCaption', json=payload)
+        resp = session.post(f'{TELEGRAM_API_URL}/editMessageCaption', json=payload)
     else:
         payload = {
             'chat_id': TELEGRAM_CHANNEL,
             'caption': msg,
             'parse_mode': 'HTML',
         }
-        resp = requests.post(f'{TELEGRAM_API_URL}/sendPhoto',
-                             data=payload,
-                             files={
-                                 'photo': open(message.image, 'rb')
-                             })
+        with open(message.image, 'rb') as photo:
+            resp = session.post(f'{TELEGRAM_API_URL}/sendPhoto',
+                                data=payload,
+                                files={
+                                    'photo': photo
+                                })
 
     # Error while editing
     if resp.status_code != 200 and telegram_message_id:
@@ -265,7 +364,7 @@ def send_message(message: TelegramMessage, telegram_message_id=None) -> int:
     return resp.json()['result']['message_id']
 
 
-def send_log(article: Article, entry):
+def send_log(article: Article, entry: FeedEntry):
     try:
         diff = get_diff(
             telegram_escape(article.title),
@@ -274,7 +373,7 @@ def send_log(article: Article, entry):
 
         timeago = humanize.naturaltime(time.time() - article.published)
 
-        requests.post(f'https://api.telegram.org/bot{BOT_TOKEN}/sendMessage', json={
+        session.post(f'{TELEGRAM_API_URL}/sendMessage', json={
             'chat_id': TELEGRAM_LOGS_CHANNEL,
             'text': f'{diff[0]}\n\n'
                     f'{diff[1]}\n\n'
@@ -293,71 +392,51 @@ def get_diff(old: str, new: str) -> list[str]:
     removed_from_new = get_diff_removals(new, old)
 
     offset = 0
-    for group in removed_from_old:
-        start = group[0] + offset
-        end = group[-1] + 1 + offset
+    for start, end in removed_from_old:
+        start += offset
+        end += offset
         old = old[:start] + '<b><u>' + old[start:end] + '</u></b>' + old[end:]
         offset += len('<u></u><b></b>')
 
     offset = 0
-    for group in removed_from_new:
-        start = group[0] + offset
-        end = group[-1] + 1 + offset
+    for start, end in removed_from_new:
+        start += offset
+        end += offset
         new = new[:start] + '<b><u>' + new[start:end] + '</u></b>' + new[end:]
         offset += len('<u></u><b></b>')
 
     return [old, new]
 
 
-def get_diff_removals(first: str, second: str) -> list:
-    diff = ndiff(first, second)
-
-    removed = []
-    offset = 0
-
-    for i, s in enumerate(diff):
-        if s[0] == ' ':
-            continue
-        elif s[0] == '+':
-            offset -= 1
-        elif s[0] == '-':
-            removed.append(i + offset)
-
-    groups = []
-    group = []
-    for i in range(len(removed)):
-        if i == 0:
-            group.append(removed[i])
-        elif removed[i] - removed[i - 1] == 1:
-            group.append(removed[i])
-        else:
-            groups.append(group)
-            group = [removed[i]]
-
-    if group:
-        groups.append(group)
-
-    return groups
+def get_diff_removals(first: str, second: str) -> list[tuple[int, int]]:
+    # (start, end) ranges of the characters of first that are missing in second
+    return [
+        (i1, i2)
+        for tag, i1, i2, j1, j2 in SequenceMatcher(None, first, second).get_opcodes()
+        if tag in ('delete', 'replace')
+    ]
 
 
 def telegram_escape(text: str) -> str:
-    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.translate(TELEGRAM_ESCAPE_TABLE)
 
 
 def clean():
     logger.info('Cleaning old articles')
     # Keep the last 200 articles
-    Article.delete().where(Article.id.not_in(
-        Article.select(Article.id).order_by(Article.id.desc()).limit(200)
-    )).execute()
+    min_id = Article.select(Article.id).order_by(Article.id.desc()).offset(199).limit(1).scalar()
+    if min_id:
+        Article.delete().where(Article.id < min_id).execute()
 
     logger.info('Cleaning old images')
-    for filename in os.listdir('images'):
-        os.remove(os.path.join('images', filename))
+    with os.scandir('images') as it:
+        for entry in it:
+            os.unlink(entry.path)
 
 
 if __name__ == '__main__':
     db.create_tables([Article])
+    logger.info('Database journal mode: ' + db.execute_sql('PRAGMA journal_mode').fetchone()[0])
     os.makedirs('images', exist_ok=True)
 
     clean()